@@ -123,4 +123,15 @@ def init_params(model, args):
         utils.load_checkpoint(model.convD, model_dir=args.m_dir)
     return model
 
-##-------------------------------------------------------------------------------------------------------------------##
\ No newline at end of file
+##-------------------------------------------------------------------------------------------------------------------##
+## Function for compiling the forward-passes of the sub-networks of [model] (in place)
+def compile_layers(model, mode=None):
+    # - the sub-networks are compiled rather than [model] itself, as training, replay and the CL-strategies all call
+    #   them directly (and this way [model] and the names of its parameters and buffers remain unchanged)
+    # - the mode is stored with each sub-network, so that copies of [model] can be compiled in the same way
+    for module in model.children():
+        module.compile(mode=mode)
+        module.compile_mode = mode
+    return model
+
+##-------------------------------------------------------------------------------------------------------------------##
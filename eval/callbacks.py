@@ -4,6 +4,15 @@ from torch.utils.data import ConcatDataset
 import utils
 
 
+def _periodic(cb, log, iters_per_task):
+    '''Attach to callback-function [cb] that it only does something every [log] iterations (so that it does not need
+    to be called in between), with the iterations counted over tasks of [iters_per_task] iterations each.'''
+    if cb is not None:
+        cb.log = log
+        cb.iters_per_task = iters_per_task
+    return cb
+
+
 #########################################################
 ## Callback-functions for evaluating model-performance ##
 #########################################################
@@ -34,7 +43,7 @@ def _sample_cb(log, config, visdom=None, pdf=None, test_datasets=None, sample_si
                                   title="Generated images{}".format(statement))
 
     # Return the callback-function (except if neither visdom or pdf is selected!)
-    return sample_cb if ((visdom is not None) or (pdf is not None)) else None
+    return _periodic(sample_cb if ((visdom is not None) or (pdf is not None)) else None, log, iters_per_task)
 
 
 
@@ -58,7 +67,7 @@ def _eval_cb(log, test_datasets, visdom=None, precision_dict=None, iters_per_tas
                                test_size=test_size, visdom=visdom)
 
     ## Return the callback-function (except if neither visdom or [precision_dict] is selected!)
-    return eval_cb if ((visdom is not None) or (precision_dict is not None)) else None
+    return _periodic(eval_cb if ((visdom is not None) or (precision_dict is not None)) else None, log, iters_per_task)
 
 
 
@@ -87,7 +96,7 @@ def _latent_space_cb(log, datasets, visdom=None, pdf=None, sample_size=400, iter
                                             pdf=pdf)
 
     # Return the callback-function (except if neither visdom or pdf is selected!)
-    return latent_space_cb if ((visdom is not None) or (pdf is not None)) else None
+    return _periodic(latent_space_cb if ((visdom is not None) or (pdf is not None)) else None, log, iters_per_task)
 
 
 
@@ -117,10 +117,15 @@ def run(args, verbose=False):
             param.requires_grad = False
 
     # Define optimizer (only optimize parameters that "requires_grad")
+    # -on the GPU, the fused implementation (if requested and available) updates all parameters in a single kernel
+    fused_adam = cuda and utils.checkattr(args, "fused_adam")
     model.optim_list = [
         {'params': filter(lambda p: p.requires_grad, model.parameters()), 'lr': args.lr},
     ]
-    model.optimizer = optim.Adam(model.optim_list, betas=(0.9, 0.999))
+    model.optimizer = optim.Adam(model.optim_list, betas=(0.9, 0.999), **utils.fused_kwargs(optim.Adam, fused_adam))
+    # - compile the model's sub-networks?
+    if utils.checkattr(args, "compile"):
+        model = define.compile_layers(model)
 
 
     #-------------------------------------------------------------------------------------------------#
@@ -133,6 +138,7 @@ def run(args, verbose=False):
     if isinstance(model, ContinualLearner) and utils.checkattr(args, 'ewc'):
         model.ewc_lambda = args.ewc_lambda if args.ewc else 0
         model.fisher_n = args.fisher_n
+        model.fisher_batch = args.fisher_batch
         model.online = utils.checkattr(args, 'online')
         if model.online:
             model.gamma = args.gamma
@@ -179,7 +185,11 @@ def run(args, verbose=False):
             {'params': filter(lambda p: p.requires_grad, generator.parameters()),
              'lr': args.lr_gen if hasattr(args, 'lr_gen') else args.lr},
         ]
-        generator.optimizer = optim.Adam(generator.optim_list, betas=(0.9, 0.999))
+        generator.optimizer = optim.Adam(generator.optim_list, betas=(0.9, 0.999),
+                                         **utils.fused_kwargs(optim.Adam, fused_adam))
+        # -compile the generator's sub-networks?
+        if utils.checkattr(args, "compile"):
+            generator = define.compile_layers(generator)
     else:
         generator = None
 
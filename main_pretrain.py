@@ -105,7 +105,11 @@ def run(args):
 
     # Set optimizer
     optim_list = [{'params': filter(lambda p: p.requires_grad, cnn.parameters()), 'lr': args.lr}]
-    cnn.optimizer = torch.optim.Adam(optim_list, betas=(0.9, 0.999))
+    fused_adam = cuda and utils.checkattr(args, "fused_adam")
+    cnn.optimizer = torch.optim.Adam(optim_list, betas=(0.9, 0.999), **utils.fused_kwargs(torch.optim.Adam, fused_adam))
+    # - compile the model's sub-networks?
+    if utils.checkattr(args, "compile"):
+        cnn = define.compile_layers(cnn)
 
 
     #-------------------------------------------------------------------------------------------------#
@@ -18,6 +18,7 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         # XdG:
         self.mask_dict = None        # -> <dict> with task-specific masks for each hidden fully-connected layer
         self.excit_buffer_list = []  # -> <list> with excit-buffers for all hidden fully-connected layers
+        self._gating_masks = {}      # -> <dict> with for each task the <list> of gating masks (once they are needed)
 
         # SI:
         self.si_c = 0           #-> hyperparam: how strong to weigh SI-loss ("regularisation strength")
@@ -28,8 +29,12 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         self.gamma = 1.         #-> hyperparam (online EWC): decay-term for old tasks' contribution to quadratic term
         self.online = True      #-> "online" (=single quadratic term) or "offline" (=quadratic term per task) EWC
         self.fisher_n = None    #-> number minibatches to use for estimating FI-matrix (if "None", one pass over data)
+        self.fisher_batch = 1   #-> number of samples for which the gradients are computed in parallel when estimating FI
         self.EWC_task_count = 0 #-> keeps track of number of quadratic loss terms (for "offline EWC")
 
+        # EWC & SI:
+        self._buffer_named_params = None  #-> <list> with (name used for buffers, param) for all trainable parameters
+
         # Replay:
         self.replay_targets = "hard"  # should distillation loss be used? (hard|soft)
         self.KD_temp = 2.             # temperature for distillation loss
@@ -41,6 +46,15 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
     def _is_on_cuda(self):
         return next(self.parameters()).is_cuda
 
+    def _buffer_named_parameters(self):
+        '''Return <list> with tuples (name, param) for all trainable parameters, with the names as used for the buffers
+        of EWC and SI (i.e., with '.' replaced by '__'); the list is composed only once, when it is first needed.'''
+        if self._buffer_named_params is None:
+            self._buffer_named_params = [
+                (n.replace('.', '__'), p) for n, p in self.named_parameters() if p.requires_grad
+            ]
+        return self._buffer_named_params
+
     @abc.abstractmethod
     def forward(self, x):
         pass
@@ -67,6 +81,7 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
                 mask_dict[task_id + 1][i] = gated_units
         self.mask_dict = mask_dict
         self.excit_buffer_list = excit_buffer_list
+        self._gating_masks = {}
 
     def apply_XdGmask(self, task):
         '''Apply task-specific mask, by setting activity of pre-selected subset of nodes to zero.
@@ -74,20 +89,23 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         [task]   <int>, starting from 1'''
 
         assert self.mask_dict is not None
-        torchType = next(self.parameters()).detach()
+
+        # The task-specific masks are only created once (on the device of the model), after that they are just copied
+        if task not in self._gating_masks:
+            self._gating_masks[task] = list()
+            for i,excit_buffer in enumerate(self.excit_buffer_list):
+                gating_mask = torch.ones_like(excit_buffer)
+                gating_mask[torch.as_tensor(self.mask_dict[task][i], device=gating_mask.device)] = 0.
+                self._gating_masks[task].append(gating_mask)             # -> find task-specifc mask
 
         # Loop over all buffers for which a task-specific mask has been specified
-        for i,excit_buffer in enumerate(self.excit_buffer_list):
-            gating_mask = np.repeat(1., len(excit_buffer))
-            gating_mask[self.mask_dict[task][i]] = 0.      # -> find task-specifc mask
-            excit_buffer.set_(torchType.new(gating_mask))  # -> apply this mask
+        for excit_buffer, gating_mask in zip(self.excit_buffer_list, self._gating_masks[task]):
+            excit_buffer.copy_(gating_mask)  # -> apply this mask
 
     def reset_XdGmask(self):
         '''Remove task-specific mask, by setting all "excit-buffers" to 1.'''
-        torchType = next(self.parameters()).detach()
         for excit_buffer in self.excit_buffer_list:
-            gating_mask = np.repeat(1., len(excit_buffer))  # -> define "unit mask" (i.e., no masking at all)
-            excit_buffer.set_(torchType.new(gating_mask))   # -> apply this unit mask
+            excit_buffer.fill_(1.)  # -> apply "unit mask" (i.e., no masking at all)
 
 
     #----------------- EWC-specifc functions -----------------#
@@ -98,61 +116,85 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         [dataset]:          <DataSet> to be used to estimate FI-matrix
         [allowed_classes]:  <list> with class-indeces of 'allowed' or 'active' classes'''
 
+        named_params = self._buffer_named_parameters()
+
         # Prepare <dict> to store estimated Fisher Information matrix
         est_fisher_info = {}
-        for n, p in self.named_parameters():
-            if p.requires_grad:
-                n = n.replace('.', '__')
-                est_fisher_info[n] = p.detach().clone().zero_()
+        for n, p in named_params:
+            est_fisher_info[n] = p.detach().clone().zero_()
 
         # Set model to evaluation mode
         mode = self.training
         self.eval()
 
-        # Create data-loader to give batches of size 1
-        data_loader = get_data_loader(dataset, batch_size=1, cuda=self._is_on_cuda())
-
-        # Estimate the FI-matrix for [self.fisher_n] batches of size 1
-        for index,(x,y) in enumerate(data_loader):
+        # If requested and available (i.e., PyTorch >= 2.0), use [torch.func] to compute the per-sample gradients for a
+        # batch of samples in parallel (only the parameters for which the FI-matrix is estimated are passed)
+        per_sample_grads = None
+        if self.fisher_batch > 1:
+            try:
+                from torch.func import functional_call, grad, vmap
+            except ImportError:
+                pass
+            else:
+                param_names = [n for n, p in self.named_parameters() if p.requires_grad]
+                params = {name: p.detach() for name, (_, p) in zip(param_names, named_params)}
+                def negloglikelihood(params, x, label):
+                    output = functional_call(self, params, (x.unsqueeze(0),))
+                    output = output if allowed_classes is None else output[:, allowed_classes]
+                    return F.cross_entropy(output, label.unsqueeze(0))
+                per_sample_grads = vmap(grad(negloglikelihood), in_dims=(None, 0, 0))
+
+        # Create data-loader to give batches of size [self.fisher_batch] (or of size 1, if no [torch.func])
+        batch_size = 1 if per_sample_grads is None else self.fisher_batch
+        data_loader = get_data_loader(dataset, batch_size=batch_size, cuda=self._is_on_cuda())
+
+        # Estimate the FI-matrix for [self.fisher_n] samples
+        n_samples = 0
+        for x, _ in data_loader:
             # Break from for-loop if max number of samples has been reached
             if self.fisher_n is not None:
-                if index >= self.fisher_n:
+                if n_samples >= self.fisher_n:
                     break
+                x = x[:(self.fisher_n - n_samples)]
             # Run forward pass of model
             x = x.to(self._device())
-            output = self(x) if allowed_classes is None else self(x)[:, allowed_classes]
+            with torch.set_grad_enabled(per_sample_grads is None):
+                output = self(x) if allowed_classes is None else self(x)[:, allowed_classes]
             # Use a weighted combination of all labels
-            with torch.no_grad():
-                label_weights = F.softmax(output, dim=1)  # --> get weights, which shouldn't have gradient tracked
+            label_weights = F.softmax(output.detach(), dim=1)
             for label_index in range(output.shape[1]):
-                label = torch.LongTensor([label_index]).to(self._device())
-                negloglikelihood = F.cross_entropy(output, label)  #--> get neg log-likelihoods for this classs
-                # Calculate gradient of negative loglikelihood
-                self.zero_grad()
-                negloglikelihood.backward(retain_graph=True if (label_index+1)<output.shape[1] else False)
-                # Square gradients and keep running sum (using the weights)
-                for n, p in self.named_parameters():
-                    if p.requires_grad:
-                        n = n.replace('.', '__')
+                label = torch.full((x.size(0),), label_index, dtype=torch.long, device=self._device())
+                if per_sample_grads is None:
+                    # Calculate gradient of negative loglikelihood for this class (for the single sample)
+                    negloglikelihood = F.cross_entropy(output, label)
+                    self.zero_grad()
+                    negloglikelihood.backward(retain_graph=True if (label_index+1)<output.shape[1] else False)
+                    # Square gradients and keep running sum (using the weights)
+                    for n, p in named_params:
                         if p.grad is not None:
-                            est_fisher_info[n] += label_weights[0][label_index] * (p.grad.detach() ** 2)
+                            est_fisher_info[n] += label_weights[0][label_index] * p.grad.detach()**2
+                else:
+                    # Calculate gradient of negative loglikelihood for this class (for all samples in the batch at once)
+                    grads = per_sample_grads(params, x, label)
+                    # Square gradients and keep running sum (using the weights)
+                    for (n, _), name in zip(named_params, param_names):
+                        est_fisher_info[n] += torch.tensordot(label_weights[:, label_index], grads[name]**2, dims=1)
+            n_samples += x.size(0)
 
         # Normalize by sample size used for estimation
-        est_fisher_info = {n: p/index for n, p in est_fisher_info.items()}
+        est_fisher_info = {n: p/n_samples for n, p in est_fisher_info.items()}
 
         # Store new values in the network
-        for n, p in self.named_parameters():
-            if p.requires_grad:
-                n = n.replace('.', '__')
-                # -mode (=MAP parameter estimate)
-                self.register_buffer('{}_EWC_prev_task{}'.format(n, "" if self.online else self.EWC_task_count+1),
-                                     p.detach().clone())
-                # -precision (approximated by diagonal Fisher Information matrix)
-                if self.online and self.EWC_task_count==1:
-                    existing_values = getattr(self, '{}_EWC_estimated_fisher'.format(n))
-                    est_fisher_info[n] += self.gamma * existing_values
-                self.register_buffer('{}_EWC_estimated_fisher{}'.format(n, "" if self.online else self.EWC_task_count+1),
-                                     est_fisher_info[n])
+        for n, p in named_params:
+            # -mode (=MAP parameter estimate)
+            self.register_buffer('{}_EWC_prev_task{}'.format(n, "" if self.online else self.EWC_task_count+1),
+                                 p.detach().clone())
+            # -precision (approximated by diagonal Fisher Information matrix)
+            if self.online and self.EWC_task_count==1:
+                existing_values = getattr(self, '{}_EWC_estimated_fisher'.format(n))
+                est_fisher_info[n] += self.gamma * existing_values
+            self.register_buffer('{}_EWC_estimated_fisher{}'.format(n, "" if self.online else self.EWC_task_count+1),
+                                 est_fisher_info[n])
 
         # If "offline EWC", increase task-count (for "online EWC", set it to 1 to indicate EWC-loss can be calculated)
         self.EWC_task_count = 1 if self.online else self.EWC_task_count + 1
@@ -167,16 +209,14 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
             losses = []
             # If "offline EWC", loop over all previous tasks (if "online EWC", [EWC_task_count]=1 so only 1 iteration)
             for task in range(1, self.EWC_task_count+1):
-                for n, p in self.named_parameters():
-                    if p.requires_grad:
-                        # Retrieve stored mode (MAP estimate) and precision (Fisher Information matrix)
-                        n = n.replace('.', '__')
-                        mean = getattr(self, '{}_EWC_prev_task{}'.format(n, "" if self.online else task))
-                        fisher = getattr(self, '{}_EWC_estimated_fisher{}'.format(n, "" if self.online else task))
-                        # If "online EWC", apply decay-term to the running sum of the Fisher Information matrices
-                        fisher = self.gamma*fisher if self.online else fisher
-                        # Calculate EWC-loss
-                        losses.append((fisher * (p-mean)**2).sum())
+                for n, p in self._buffer_named_parameters():
+                    # Retrieve stored mode (MAP estimate) and precision (Fisher Information matrix)
+                    mean = getattr(self, '{}_EWC_prev_task{}'.format(n, "" if self.online else task))
+                    fisher = getattr(self, '{}_EWC_estimated_fisher{}'.format(n, "" if self.online else task))
+                    # If "online EWC", apply decay-term to the running sum of the Fisher Information matrices
+                    fisher = self.gamma*fisher if self.online else fisher
+                    # Calculate EWC-loss
+                    losses.append((fisher * (p-mean)**2).sum())
             # Sum EWC-loss from all parameters (and from all tasks, if "offline EWC")
             return (1./2)*sum(losses)
         else:
@@ -192,39 +232,45 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         [W]         <dict> estimated parameter-specific contribution to changes in total loss of completed task
         [epsilon]   <float> dampening parameter (to bound [omega] when [p_change] goes to 0)'''
 
-        # Loop over all parameters
-        for n, p in self.named_parameters():
-            if p.requires_grad:
-                n = n.replace('.', '__')
-
-                # Find/calculate new values for quadratic penalty on parameters
-                p_prev = getattr(self, '{}_SI_prev_task'.format(n))
-                p_current = p.detach().clone()
-                p_change = p_current - p_prev
-                omega_add = W[n]/(p_change**2 + epsilon)
-                try:
-                    omega = getattr(self, '{}_SI_omega'.format(n))
-                except AttributeError:
-                    omega = p.detach().clone().zero_()
-                omega_new = omega + omega_add
+        named_params = self._buffer_named_parameters()
+
+        # Find/calculate new values for quadratic penalty on parameters (for all parameters together, using "foreach"-
+        # operations if the installed version of PyTorch has them; otherwise one parameter at a time)
+        foreach = hasattr(torch, '_foreach_div')
+        p_prev = [getattr(self, '{}_SI_prev_task'.format(n)) for n, _ in named_params]
+        p_current = [p.detach().clone() for _, p in named_params]
+        if foreach:
+            denominator = torch._foreach_sub(p_current, p_prev)
+            torch._foreach_mul_(denominator, denominator)
+            torch._foreach_add_(denominator, epsilon)           #--> p_change**2 + epsilon
+            omega_add = torch._foreach_div([W[n] for n, _ in named_params], denominator)
+        else:
+            omega_add = [W[n]/((p_current_n-p_prev_n)**2 + epsilon)
+                         for (n, _), p_current_n, p_prev_n in zip(named_params, p_current, p_prev)]
+        try:
+            omega = [getattr(self, '{}_SI_omega'.format(n)) for n, _ in named_params]
+            omega_new = torch._foreach_add(omega, omega_add) if foreach else [
+                omega_n + omega_add_n for omega_n, omega_add_n in zip(omega, omega_add)
+            ]
+        except AttributeError:
+            omega_new = omega_add
 
-                # Store these new values in the model
-                self.register_buffer('{}_SI_prev_task'.format(n), p_current)
-                self.register_buffer('{}_SI_omega'.format(n), omega_new)
+        # Store these new values in the model
+        for (n, _), p_current_n, omega_new_n in zip(named_params, p_current, omega_new):
+            self.register_buffer('{}_SI_prev_task'.format(n), p_current_n)
+            self.register_buffer('{}_SI_omega'.format(n), omega_new_n)
 
 
     def surrogate_loss(self):
         '''Calculate SI's surrogate loss.'''
         try:
             losses = []
-            for n, p in self.named_parameters():
-                if p.requires_grad:
-                    # Retrieve previous parameter values and their normalized path integral (i.e., omega)
-                    n = n.replace('.', '__')
-                    prev_values = getattr(self, '{}_SI_prev_task'.format(n))
-                    omega = getattr(self, '{}_SI_omega'.format(n))
-                    # Calculate SI's surrogate loss, sum over all parameters
-                    losses.append((omega * (p-prev_values)**2).sum())
+            for n, p in self._buffer_named_parameters():
+                # Retrieve previous parameter values and their normalized path integral (i.e., omega)
+                prev_values = getattr(self, '{}_SI_prev_task'.format(n))
+                omega = getattr(self, '{}_SI_omega'.format(n))
+                # Calculate SI's surrogate loss, sum over all parameters
+                losses.append((omega * (p-prev_values)**2).sum())
             return sum(losses)
         except AttributeError:
             # SI-loss is 0 if there is no stored omega yet
@@ -163,10 +163,11 @@ class Classifier(ContinualLearner):
             loss_cur = predL
 
             # Calculate training-precision
-            precision = None if y is None else (y == y_hat.max(1)[1]).sum().item() / x.size(0)
+            precision = None if y is None else (y == y_hat.argmax(dim=1)).sum().item() / x.size(0)
 
-            # If XdG is combined with replay, backward-pass needs to be done before new task-mask is applied
-            if (self.mask_dict is not None) and (x_ is not None):
+            # If there is also replay, do the backward-pass for the current data already, so that its activations can
+            # be freed before the replayed data is run (with XdG, this is anyway needed before new task-mask is applied)
+            if x_ is not None:
                 weighted_current_loss = rnt*loss_cur
                 weighted_current_loss.backward()
         else:
@@ -249,7 +250,16 @@ class Classifier(ContinualLearner):
 
         # Backpropagate errors (if not yet done)
         if (self.mask_dict is None) or (x_ is None):
-            loss_total.backward()
+            if (x is None) or (x_ is None):
+                loss_total.backward()
+            else:
+                # -the current data was already backpropagated, so only the replayed data and allocation losses remain
+                loss_remaining = (1-rnt)*loss_replay
+                if self.si_c>0:
+                    loss_remaining = loss_remaining + self.si_c * surrogate_loss
+                if self.ewc_lambda>0:
+                    loss_remaining = loss_remaining + self.ewc_lambda * ewc_loss
+                loss_remaining.backward()
         # Take optimization-step
         self.optimizer.step()
 
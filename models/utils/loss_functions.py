@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 from torch.nn import functional as F
 
@@ -97,11 +96,9 @@ def to_one_hot(y, classes, device=None):
     '''Convert <nd-array> or <tensor> with integers [y] to a 2D "one-hot" <tensor>.'''
     if type(y)==torch.Tensor:
         device=y.device
-        y = y.cpu()
-    c = np.zeros(shape=[len(y), classes], dtype='float32')
-    c[range(len(y)), y] = 1.
-    c = torch.from_numpy(c)
-    return c if device is None else c.to(device)
+    # -a <tensor> stays where it is, an <nd-array> is copied to [device] only once (and not the larger one-hot version)
+    y = torch.as_tensor(y, dtype=torch.long, device=device)
+    return F.one_hot(y, num_classes=classes).float()
 
 
 ##-------------------------------------------------------------------------------------------------------------------##
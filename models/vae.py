@@ -312,7 +312,7 @@ class AutoEncoder(ContinualLearner):
         '''Generate [size] samples from the model. Outputs are tensors (not "requiring grad"), on same device as <self>.
 
         INPUT:  - [allowed_classes]     <list> of [class_ids] from which to sample
-                - [class_probs]         <list> with for each class the probability it is sampled from it
+                - [class_probs]         <list> or <1D-tensor> with for each class the probability it is sampled from it
                 - [sample_mode]         <int> to sample from specific mode of [z]-distr'n, overwrites [allowed_classes]
                 - [allowed_domains]     <list> of [task_ids] which are allowed to be used for 'task-gates' (if used)
                                           NOTE: currently only relevant if [scenario]=="domain"
@@ -325,6 +325,10 @@ class AutoEncoder(ContinualLearner):
         # set model to eval()-mode
         self.eval()
 
+        # if [class_probs] is given as a (possibly GPU-)tensor, move it to the host in one go (rather than once per class)
+        if torch.is_tensor(class_probs):
+            class_probs = class_probs.tolist()
+
         # pick for each sample the prior-mode to be used
         if self.prior=="GMM":
             if sample_mode is None:
@@ -344,7 +348,7 @@ class AutoEncoder(ContinualLearner):
                         allowed_modes += list(range(class_id * self.modes_per_class, (class_id+1)*self.modes_per_class))
                         if class_probs is not None:
                             for i in range(self.modes_per_class):
-                                unweighted_probs.append(class_probs[index].item())
+                                unweighted_probs.append(class_probs[index])
                     mode_probs = None if class_probs is None else [p / sum(unweighted_probs) for p in unweighted_probs]
                     sampled_modes = np.random.choice(allowed_modes, size, p=mode_probs, replace=True)
                     y_used = np.array([int(mode / self.modes_per_class) for mode in sampled_modes])
@@ -391,8 +395,8 @@ class AutoEncoder(ContinualLearner):
                 # diffVector = torch.tensor(diffVector).to(self._device())
                 # print(diffVector)
 
-                # HERE'S THIS, BUT WITH MASKING
-                diffVector = (D * classVarietyMask).sum(1)
+                # HERE'S THIS, BUT WITH MASKING (the mask is a <bool>-tensor, True for pairs of samples of same class)
+                diffVector = D.masked_fill(~classVarietyMask, 0.).sum(1)
 
             else:
                 diffVector = torch.cdist(z, z).sum(1)
@@ -790,7 +794,7 @@ class AutoEncoder(ContinualLearner):
             # If using task-gates, create [task_tensor] as it's needed in the decoder
             task_tensor = None
             if self.dg_gates and self.dg_type=="task":
-                task_tensor = torch.tensor(np.repeat(task-1, x.size(0))).to(self._device())
+                task_tensor = torch.full((x.size(0),), task-1, dtype=torch.long, device=self._device())
 
             # Run the model
             x = self.convE(x) if self.hidden else x   # -pre-processing (if 'hidden')
@@ -815,11 +819,12 @@ class AutoEncoder(ContinualLearner):
 
             # Calculate training-precision
             if y is not None and y_hat is not None:
-                _, predicted = y_hat.max(1)
+                predicted = y_hat.argmax(dim=1)
                 precision = (y == predicted).sum().item() / x.size(0)
 
-            # If XdG is combined with replay, backward-pass needs to be done before new task-mask is applied
-            if (self.mask_dict is not None) and (x_ is not None):
+            # If there is also replay, do the backward-pass for the current data already, so that its activations can
+            # be freed before the replayed data is run (with XdG, this is anyway needed before new task-mask is applied)
+            if x_ is not None:
                 weighted_current_loss = rnt*loss_cur
                 weighted_current_loss.backward()
 
@@ -941,7 +946,16 @@ class AutoEncoder(ContinualLearner):
 
         # Backpropagate errors (if not yet done)
         if (self.mask_dict is None) or (x_ is None):
-            loss_total.backward()
+            if (x is None) or (x_ is None):
+                loss_total.backward()
+            else:
+                # -the current data was already backpropagated, so only the replayed data and allocation losses remain
+                loss_remaining = (1-rnt)*loss_replay
+                if self.si_c>0:
+                    loss_remaining = loss_remaining + self.si_c * surrogate_loss
+                if self.ewc_lambda>0:
+                    loss_remaining = loss_remaining + self.ewc_lambda * ewc_loss
+                loss_remaining.backward()
         # Take optimization-step
         self.optimizer.step()
 
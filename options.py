@@ -149,6 +149,9 @@ def add_train_options(parser, only_MNIST=False, single_task=False, generative=Fa
     train_params.add_argument('--batch', type=int, default=256 if single_task else None, help="batch-size")
     train_params.add_argument('--init-weight', type=str, default='standard', choices=['standard', 'xavier'])
     train_params.add_argument('--init-bias', type=str, default='standard', choices=['standard', 'constant'])
+    train_params.add_argument('--compile', action='store_true', help="compile the networks with 'torch.compile'")
+    train_params.add_argument('--fused-adam', action='store_true',
+                              help="use the fused implementation of Adam (on the GPU, if supported by PyTorch)")
     if not single_task and compare_code not in ('replay'):
         train_params.add_argument('--reinit', action='store_true', help='reinitialize networks before each new task')
     if not only_MNIST:
@@ -254,6 +257,9 @@ def add_allocation_options(parser, compare_code="none", **kwargs):
     if not compare_code in ('hyper'):
         cl.add_argument('--gamma', type=float, help="--> EWC: forgetting coefficient (for 'online EWC')")
     cl.add_argument('--fisher-n', type=int, default=1000, help="--> EWC: sample size estimating Fisher Information")
+    cl.add_argument('--fisher-batch', type=int, default=1, metavar='N',
+                    help="--> EWC: # samples processed in parallel when estimating Fisher Information (needs "
+                         "'torch.func'; memory use grows with N x # parameters)")
     if compare_code in ("none"):
         cl.add_argument('--si', action='store_true', help="use 'Synaptic Intelligence' (Zenke, Poole et al, 2017)")
     if not compare_code in ('hyper'):
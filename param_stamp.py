@@ -61,13 +61,14 @@ def get_param_stamp(args, model_name, verbose=True, replay=False, replay_model_n
     if (checkattr(args, "freeze_convD") or checkattr(args, "freeze_convE")) and hasattr(args, 'depth') and args.depth>0:
         freeze_conv = "-fCvE" if checkattr(args, "freeze_convE") else "-fCvD"
         freeze_conv = "-fConv" if checkattr(args, "freeze_convE") and checkattr(args, "freeze_convD") else freeze_conv
-    hyper_stamp = "{i_e}{num}-lr{lr}{lrg}-b{bsz}{pretr}{freeze}{reinit}".format(
+    hyper_stamp = "{i_e}{num}-lr{lr}{lrg}-b{bsz}{pretr}{freeze}{reinit}{fused}".format(
         i_e="e" if args.iters is None else "i", num=args.epochs if args.iters is None else args.iters, lr=args.lr,
         lrg=("" if args.lr==args.lr_gen else "-lrG{}".format(args.lr_gen)) if (
             hasattr(args, "lr_gen") and hasattr(args, "replay") and args.replay=="generative" and
             (not checkattr(args, "feedback"))
         ) else "",
-        bsz=args.batch, pretr=pre_conv, freeze=freeze_conv, reinit="-R" if checkattr(args, 'reinit') else ""
+        bsz=args.batch, pretr=pre_conv, freeze=freeze_conv, reinit="-R" if checkattr(args, 'reinit') else "",
+        fused="-fA" if checkattr(args, 'fused_adam') else "",
     )
     if verbose:
         print(" --> hyper-params:  " + hyper_stamp)
@@ -1,12 +1,13 @@
-import numpy as np
 import torch
-from torch import nn
+from torch.nn import functional as F
 from torch.utils.data import ConcatDataset
 import tqdm
-import copy
 import utils
 from models.cl.continual_learner import ContinualLearner
 
+# Context-manager for forward passes that are only used for scoring (falls back to [no_grad] for PyTorch < 1.9)
+inference_mode = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
+
 
 def train(model, train_loader, iters, loss_cbs=list(), eval_cbs=list(), save_every=None, m_dir="./store/models",
           args=None):
@@ -31,11 +32,10 @@ def train(model, train_loader, iters, loss_cbs=list(), eval_cbs=list(), save_eve
         epoch += 1
 
         # Loop over all batches of an epoch
-        for batch_idx, (data, y) in enumerate(train_loader):
+        for batch_idx, (data, y) in enumerate(utils.DataPrefetcher(train_loader, device)):
             iteration += 1
 
-            # Perform training-step on this batch
-            data, y = data.to(device), y.to(device)
+            # Perform training-step on this batch (it is already moved to [device] by the prefetcher)
             loss_dict = model.train_a_batch(data, y=y, freeze_convE=freeze_convE)
 
             # Fire training-callbacks (for visualization of training-progress)
@@ -59,6 +59,16 @@ def train(model, train_loader, iters, loss_cbs=list(), eval_cbs=list(), save_eve
 
 
 
+def _with_period(callbacks, task):
+    '''Return <list> with for each (not-None) callback-function in [callbacks] a tuple ([cb], [offset], [log]), so that
+    [cb] is only due to be called after batch [b] of [task] if ([offset] + [b]) % [log] == 0.
+
+    Callback-functions that did not get a [log] attached (see "eval/callbacks.py") are due after every batch.'''
+    return [(cb, (task-1)*(getattr(cb, 'iters_per_task', None) or 0), getattr(cb, 'log', 1))
+            for cb in callbacks if cb is not None]
+
+
+
 def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=None, classes_per_task=None,
              iters=2000, batch_size=32, batch_size_replay=None, loss_cbs=list(), eval_cbs=list(), sample_cbs=list(),
              generator=None, gen_iters=0, gen_loss_cbs=list(), feedback=False, reinit=False, args=None, only_last=False,
@@ -97,16 +107,48 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
     # Set default-values if not specified
     batch_size_replay = batch_size if batch_size_replay is None else batch_size_replay
 
+    # For curated sampling, are the generated samples scored before and/or after a virtual update on the current data?
+    score_before_update = sample_method in ('curated', 'curated_softmax', 'curated_variety', 'curated_classVariety',
+                                            'interfered')
+    score_after_update = score_before_update or sample_method=='misclassified'
+
+    # Which regularization-based CL-strategies are used? (and should the main model's samples be evaluated?)
+    SI = isinstance(model, ContinualLearner) and model.si_c>0
+    EWC = isinstance(model, ContinualLearner) and model.ewc_lambda>0
+    sample_main_model = (model.label=="VAE")
+
     # Initiate indicators for replay (no replay for 1st task)
     Generative = Current = Offline_TaskIL = False
-    previous_model = None
+    previous_model = previous_generator = None
+
+    # Store initial state of the network(s), if they should be reinitialized before each new task
+    if reinit:
+        init_state = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+        if generator is not None:
+            gen_init_state = {name: tensor.detach().clone() for name, tensor in generator.state_dict().items()}
 
     # Register starting param-values (needed for "intelligent synapses").
-    if isinstance(model, ContinualLearner) and model.si_c>0:
-        for n, p in model.named_parameters():
-            if p.requires_grad:
-                n = n.replace('.', '__')
-                model.register_buffer('{}_SI_prev_task'.format(n), p.detach().clone())
+    if SI:
+        # -collect (only once) all trainable parameters, together with the names under which SI stores them
+        si_params = model._buffer_named_parameters()
+        for n, p in si_params:
+            model.register_buffer('{}_SI_prev_task'.format(n), p.detach().clone())
+        # -the parameters whose running importance estimates are updated during training (in a fixed order, so that
+        #  the updates of all of them can be done together using "foreach"-operations)
+        si_updated = [(n, p) for n, p in si_params if n.split('__')[0] in ('convE', 'fcE', 'classifier')]
+        # -contiguous buffers for the running importance estimates of all parameters ([W]) and for the values before
+        #  each update of those updated during training ([p_old]); allocated only once, they are reset in place
+        W_flat, W_views = utils.flat_buffer([p for _, p in si_params])
+        W = {n: W_view for (n, _), W_view in zip(si_params, W_views)}
+        W_list = [W[n] for n, _ in si_updated]
+        _, p_old_list = utils.flat_buffer([p for _, p in si_updated])
+        si_values = [p.detach() for _, p in si_updated]
+        # -the "foreach"-operations need a recent version of PyTorch (>= 2.1), otherwise loop over the parameters
+        si_foreach = hasattr(torch, '_foreach_copy_')
+
+    # Leave out the callback-functions that are not used
+    loss_cbs = [cb for cb in loss_cbs if cb is not None]
+    gen_loss_cbs = [cb for cb in gen_loss_cbs if cb is not None]
 
     # Loop over all tasks.
     for task, train_dataset in enumerate(train_datasets, 1):
@@ -117,20 +159,23 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
         # -but if "offline"+"task": all tasks so far should be visited separately (i.e., separate data-loader per task)
         if replay_mode=="offline" and scenario=="task":
             Offline_TaskIL = True
-            data_loader = [None]*task
 
-        # Initialize # iters left on data-loader(s)
-        iters_left = 1 if (not Offline_TaskIL) else [1]*task
+        # Batch-sizes per task if each task so far is visited separately (i.e., "offline"+"task" or conditional replay)
+        batch_size_to_use = -(-batch_size // task)                                  #--> integer version of ceil()
+        batch_size_replay_to_use = -(-batch_size_replay // (task-1)) if task>1 else None
 
-        # Prepare <dicts> to store running importance estimates and parameter-values before update
-        if isinstance(model, ContinualLearner) and model.si_c>0:
-            W = {}
-            p_old = {}
-            for n, p in model.named_parameters():
-                if p.requires_grad:
-                    n = n.replace('.', '__')
-                    W[n] = p.data.clone().zero_()
-                    p_old[n] = p.data.clone()
+        # Relative importance of the new task (if not specified, relative to the number of tasks so far)
+        rnt_to_use = (1. if task==1 else 1./task) if rnt is None else rnt
+
+        # Reset the running importance estimates and the parameter-values before update
+        if SI:
+            W_flat.zero_()
+            if si_foreach:
+                torch._foreach_copy_(p_old_list, si_values)
+            else:
+                for p_old, value in zip(p_old_list, si_values):
+                    p_old.copy_(value)
+            with_grad = None
 
         # Find [active_classes] (=classes in current task)
         active_classes = None  #-> for "domain"- or "all"-scenarios, always all classes are active
@@ -141,12 +186,24 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
             # -for "class"-scenario, create one <list> with active classes of all tasks so far
             active_classes = list(range(classes_per_task*task))
 
+        # Find classes and tasks/domains of which replay can be generated (=those of all previous tasks)
+        # -which classes are allowed to be generated? (relevant if conditional generator / decoder-gates)
+        allowed_classes = None if scenario=="domain" else list(range(classes_per_task*(task-1)))
+        # -which tasks/domains are allowed to be generated? (only relevant if "Domain-IL" with task-gates)
+        allowed_domains = list(range(task-1))
+        # Find after which batches the evaluation- and sample-callbacks should be called
+        eval_cbs_task = _with_period(eval_cbs, task)
+        sample_cbs_task = _with_period(sample_cbs, task)
+        # -which classes should the sample-callbacks generate? (=those of all tasks so far)
+        sample_cb_classes = None if scenario=="domain" else list(range(classes_per_task*task))
+
         # Reinitialize the model's parameters (if requested)
+        # -NOTE: buffers added after the start of training (e.g., for SI or EWC) are not in the initial state and
+        #        are therefore left untouched (hence "strict=False")
         if reinit:
-            from define_models import init_params
-            init_params(model, args)
+            model.load_state_dict(init_state, strict=False)
             if generator is not None:
-                init_params(generator, args)
+                generator.load_state_dict(gen_init_state, strict=False)
 
         # Define a tqdm progress bar(s)
         iters_main = iters
@@ -166,56 +223,60 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
         if (sample_method=="curated_classVariety" and (task-1)>0):
             sampleAmt = batch_size_replay * curated_multiplier
             classNum = classes_per_task*(task-1)
-            indexList = [[idx for idx in range(sampleAmt) if (idx%classNum) == (rowIdx%classNum)] for rowIdx in range(sampleAmt)]
-            mask = []
-            for rowIdxList in indexList:
-                curRow = [0] * sampleAmt
-                for idx in rowIdxList:
-                    curRow[idx] = 1
-                mask.append(curRow)
-            mask = torch.tensor(mask, dtype=torch.float).to(device)
-
+            # -entry [i,j] is True if samples i and j are of the same class (samples are generated as [0,1,...,classNum-1,0,...])
+            sample_ids = torch.arange(sampleAmt, device=device)
+            mask = (sample_ids[:, None] % classNum) == (sample_ids[None, :] % classNum)
+
+        # For curated sampling with balanced classes: how many examples of each class should be selected
+        counts_each_class = None
+        if (allowed_classes is not None) and (task-1)>0:
+            # Uniform dist will be [0, 1, 2, 3, 0, 1, 2] for allowed classes=4 and batch_size_replay=7
+            uniform_dist = torch.arange(batch_size_replay, device=device) % len(allowed_classes)
+            counts_each_class = torch.bincount(uniform_dist, minlength=len(allowed_classes))
+
+        # Create the data-loader(s) for this task, which start a new epoch by themselves whenever they are exhausted
+        if not Offline_TaskIL:
+            data_loader = utils.DataPrefetcher(
+                utils.get_data_loader(train_dataset, batch_size, cuda=cuda, drop_last=True), device, cycle=True
+            )
+        else:
+            # -with "offline replay" in Task-IL scenario, there is a separate data-loader for each task
+            data_loader = [utils.DataPrefetcher(utils.get_data_loader(
+                train_datasets[task_id], batch_size_to_use, cuda=cuda, drop_last=True
+            ), device, cycle=True) for task_id in range(task)]
+
+        # For (curated) softmax sampling: use previous model to score a batch of images from this new task, and sample
+        # the previous classes according to how much they are confused with this new task (computed once per task)
+        sampleProbs = None
+        if Generative and sample_method in ("softmax", "curated_softmax"):
+            x_rep, _ = next(iter(utils.get_data_loader(train_dataset, batch_size, cuda=cuda, drop_last=True)))
+            with inference_mode():
+                newScores_og = previous_model.classify(previous_model.input_to_hidden(x_rep.to(device)),
+                                                       not_hidden=False)
+                scores_old = F.softmax(newScores_og[:, :(classes_per_task*(task-1))], dim=1)
+                sampleProbs = torch.zeros(newScores_og.shape[1], device=device)
+                sampleProbs[:(classes_per_task*(task-1))] = torch.mean(scores_old, dim=0)
 
         for batch_index in range(1, iters_to_use+1):
 
-            # Update # iters left on current data-loader(s) and, if needed, create new one(s)
-            if not Offline_TaskIL:
-                iters_left -= 1
-                if iters_left==0:
-                    data_loader = iter(utils.get_data_loader(train_dataset, batch_size, cuda=cuda, drop_last=True))
-                    iters_left = len(data_loader)
-            else:
-                # -with "offline replay" in Task-IL scenario, there is a separate data-loader for each task
-                batch_size_to_use = int(np.ceil(batch_size/task))
-                for task_id in range(task):
-                    iters_left[task_id] -= 1
-                    if iters_left[task_id]==0:
-                        data_loader[task_id] = iter(utils.get_data_loader(
-                            train_datasets[task_id], batch_size_to_use, cuda=cuda, drop_last=True
-                        ))
-                        iters_left[task_id] = len(data_loader[task_id])
-
-
-
             #-----------------Collect data------------------#
 
             #####-----CURRENT BATCH-----#####
             if not Offline_TaskIL:
                 x, y = next(data_loader)                                    #--> sample training data of current task
                 y = y-classes_per_task*(task-1) if scenario=="task" else y  #--> ITL: adjust y-targets to 'active range'
-                x, y = x.to(device), y.to(device)                           #--> transfer them to correct device
                 #y = y.expand(1) if len(y.size())==1 else y                 #--> hack for if batch-size is 1
             else:
                 x = y = task_used = None  #--> all tasks are "treated as replay"
-                # -sample training data for all tasks so far, move to correct device and store in lists
+                # -sample training data for all tasks so far (already on correct device) and store in lists
                 x_, y_ = list(), list()
                 for task_id in range(task):
                     x_temp, y_temp = next(data_loader[task_id])
-                    x_.append(x_temp.to(device))
+                    x_.append(x_temp)
                     y_temp = y_temp - (classes_per_task * task_id) #--> adjust y-targets to 'active range'
                     if batch_size_to_use == 1:
-                        y_temp = torch.tensor([y_temp])            #--> correct dimensions if batch-size is 1
-                    y_.append(y_temp.to(device))
+                        y_temp = y_temp.expand(1)                  #--> correct dimensions if batch-size is 1
+                    y_.append(y_temp)
 
 
             #####-----REPLAYED BATCH-----#####
@@ -244,36 +305,19 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
                     x_ = list()
                     task_used = list()
                     for task_id in range(task-1):
-                        allowed_classes = list(range(classes_per_task*task_id, classes_per_task*(task_id+1)))
-                        batch_size_replay_to_use = int(np.ceil(batch_size_replay / (task-1)))
-                        x_temp_ = previous_generator.sample(batch_size_replay_to_use, allowed_classes=allowed_classes,
-                                                            only_x=False)
+                        x_temp_ = previous_generator.sample(batch_size_replay_to_use,
+                                                            allowed_classes=active_classes[task_id], only_x=False)
                         x_.append(x_temp_[0])
                         task_used.append(x_temp_[2])
                 else:
-                    # -which classes are allowed to be generated? (relevant if conditional generator / decoder-gates)
-                    allowed_classes = None if scenario=="domain" else list(range(classes_per_task*(task-1)))
-                    # -which tasks/domains are allowed to be generated? (only relevant if "Domain-IL" with task-gates)
-                    allowed_domains = list(range(task-1))
                     # -generate inputs representative of previous tasks
 
                     # --- SAMPLE METHOD CHOICES: softmax, random, uniform, curated ---
                     # --- Softmax sampling: use previous model to score images from this new task, generate those classes
                     if sample_method == 'softmax':
-                        with torch.no_grad():
-                            curTaskID = task - 2
-                            newScores_og = previous_model.classify(previous_model.input_to_hidden(x),
-                                                                   not_hidden=False if Generative else True)
-                            newScores = newScores_og[:, :(classes_per_task * (curTaskID + 1))]
-                            softmax = torch.nn.Softmax(dim=1)
-                            scores_old = nn.Softmax(dim=1)(newScores)
-                            avgError = torch.mean(scores_old, dim=0)
-                            sampleProbs = torch.zeros(newScores_og.shape[1])
-                            sampleProbs[:(classes_per_task * (curTaskID + 1))] = avgError[
-                                                                                 :(classes_per_task * (curTaskID + 1))]
-                            x_, y_used, task_used = previous_generator.sample(
-                                batch_size_replay, allowed_classes=allowed_classes, allowed_domains=allowed_domains,
-                                only_x=False, class_probs=sampleProbs,uniform_sampling=False)
+                        x_, y_used, task_used = previous_generator.sample(
+                            batch_size_replay, allowed_classes=allowed_classes, allowed_domains=allowed_domains,
+                            only_x=False, class_probs=sampleProbs,uniform_sampling=False)
                         
                     # --- Uniformly random sampling (baseline) ---
                     elif sample_method == 'random':
@@ -303,19 +347,6 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
                                 only_x=False, class_probs=None, uniform_sampling=True, varietyVector=True, classVariety=True, classVarietyMask=mask)
 
                         elif(sample_method == "curated_softmax"):
-
-                            with torch.no_grad():
-                                curTaskID = task - 2
-                                newScores_og = previous_model.classify(previous_model.input_to_hidden(x),
-                                                                       not_hidden=False if Generative else True)
-                                newScores = newScores_og[:, :(classes_per_task * (curTaskID + 1))]
-                                softmax = torch.nn.Softmax(dim=1)
-                                scores_old = nn.Softmax(dim=1)(newScores)
-                                avgError = torch.mean(scores_old, dim=0)
-                                sampleProbs = torch.zeros(newScores_og.shape[1])
-                                sampleProbs[:(classes_per_task * (curTaskID + 1))] = avgError[
-                                                                                     :(classes_per_task * (curTaskID + 1))]
-
                             # Generate x times as many samples as we need to then pick the best of
                             x_, y_used, task_used = previous_generator.sample(
                                 batch_size_replay * curated_multiplier, allowed_classes=allowed_classes, allowed_domains=allowed_domains,
@@ -328,110 +359,119 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
                                 batch_size_replay * curated_multiplier, allowed_classes=allowed_classes, allowed_domains=allowed_domains,
                                 only_x=False, class_probs=None, uniform_sampling=False)
 
+                        # The labels of the generated samples are needed on the device (convert only once)
+                        y_used = torch.as_tensor(y_used, dtype=torch.long, device=device)
+
                         # --- Measure the performance of each of these samples on the current model ---
                         # Use the previous model to score the generated images (code taken from Trevor's softmax above)
-                        with torch.no_grad():
-                            curTaskID = task - 2
-                            newScores_og = model.classify(x_, not_hidden=False if Generative else True).to(device)
-                            newScores = newScores_og[:, :(classes_per_task * (curTaskID + 1))].to(device) # Logits that don't sum to 1
-                            scores_old = nn.Softmax(dim=1)(newScores).to(device) # Makes the scores sum to 1 (probabilities)
-                            cross_entropy = nn.CrossEntropyLoss(reduction='none').to(device)
-                            y_used = torch.tensor(y_used, dtype=torch.long).to(device)
-                            loss_old = cross_entropy(scores_old, y_used).to(device)
-
-                        # --- Copy the model and perform an update on just the new incoming data (no replayed data) ---
+                        if score_before_update:
+                            with inference_mode():
+                                curTaskID = task - 2
+                                newScores_og = model.classify(x_, not_hidden=False if Generative else True)
+                                newScores = newScores_og[:, :(classes_per_task * (curTaskID + 1))] # Logits that don't sum to 1
+                                loss_old = F.cross_entropy(newScores, y_used, reduction='none') # Per-example cross entropy (from logits)
+                                if sample_method == 'interfered':
+                                    scores_old = F.softmax(newScores, dim=1) # Makes the scores sum to 1 (probabilities)
+
+                        # --- Perform a (virtual) update on just the new incoming data (no replayed data) ---
                         # This will lead to catastrophic forgetting, as it has no replays to prevent this from happening
-                        model_tmp = copy.deepcopy(model)
-                        # NOTE: Can train multiple batches if needed, but it would be on the same data, so any changes will just be exacerbated
-                        _ = model_tmp.train_a_batch(x, y=y, x_=None, y_=None, scores_=None,
-                                                        tasks_=task_used, active_classes=active_classes, task=task, rnt=(
-                                                            1. if task==1 else 1./task
-                                                        ) if rnt is None else rnt, freeze_convE=freeze_convE,
-                                                        replay_not_hidden=False if Generative else True)
+                        # (the state of the model and its optimizer is stored first, so that this update can be undone)
+                        if score_after_update:
+                            model_state = utils.snapshot_state(model)
+                            # NOTE: Can train multiple batches if needed, but it would be on the same data, so any changes will just be exacerbated
+                            _ = model.train_a_batch(x, y=y, x_=None, y_=None, scores_=None,
+                                                    tasks_=task_used, active_classes=active_classes, task=task,
+                                                    rnt=rnt_to_use, freeze_convE=freeze_convE,
+                                                    replay_not_hidden=False if Generative else True)
 
                         # --- Measure the performance of each of the generated samples on this updated model ---
                         # This can tell us how much the model 'forgets' each of these samples, we will replay the worst ones
-                        with torch.no_grad():
-                            curTaskID = task - 2
-                            newScores_og = model_tmp.classify(x_, not_hidden=False if Generative else True).to(device)
-                            newScores = newScores_og[:, :(classes_per_task * (curTaskID + 2))].to(device) # Logits that don't sum to 1
-                            scores_new = nn.Softmax(dim=1)(newScores).to(device) # Makes the scores sum to 1 (probabilities)
-
-                            # --- Measure the difference in cross entropy loss for predictions before and after ---
-                            if sample_method == 'curated' or sample_method == "curated_softmax":
-                                cross_entropy = nn.CrossEntropyLoss(reduction='none') # Per-example cross entropy (not avg)
-                                loss_new = cross_entropy(scores_new, y_used)
-
-                                # Amount that the loss changes between the model updating
-                                diff = loss_new - loss_old
-                                metric = diff
-
-                            # TREVOR'S NEW METHOD - This tries to take into account the variety of the samples
-                            elif sample_method == "curated_variety" or sample_method == "curated_classVariety":
-                                cross_entropy = nn.CrossEntropyLoss(reduction='none').to(device) # Per-example cross entropy (not avg)
-                                loss_new = cross_entropy(scores_new, y_used).to(device)
-
-                                # Amount that the loss changes between the model updating
-                                diff = loss_new - loss_old
-                                
-                                # Softmaxing diff and the variety vector (to get probabilities)
-                                variety_weight = torch.tensor((variety_weight)).to(device)
-                                diff_softmax = nn.Softmax(dim=0)(diff).to(device)
-                                variety_softmax = nn.Softmax(dim=0)(varietyVector).to(device)
-                                metric = ((1-variety_weight) * diff_softmax) + (variety_weight * variety_softmax).to(device)
-
-                            # Multiply the misclassification error (cross entropy) by the amount that this changes between the model updating
-                            # metric = loss_new * diff
-
-                            # --- Measure KL Divergence between predictions before and predictions afterwards ---
-                            # Maximally Interfered Retrieval uses a linear combination of KL, entropy, and 'variance'
-                            # This ensures the samples are not too close together, but we do not currently measure that
-                            elif sample_method == 'interfered':
-                                # First, pad with zeros so predictions match (previous model predicts zero score for all new classes)
-                                padded_scores = torch.zeros_like(scores_new)
-                                padded_scores[:, :scores_old.size(1)] = scores_old
-                                kl_div = nn.KLDivLoss(reduction='none')(padded_scores, scores_new)
-                                kl_div = torch.mean(kl_div, dim=1)
-                                variety_softmax = nn.Softmax(dim=0)(varietyVector).to(device)
-
-                                # Calculate MIR loss and balance with variety (instead of explicitly searching, maximize both variety and MIR loss)
-                                mir_loss = kl_div - mir_coef * loss_old
-                                metric = (1-variety_weight) * (mir_loss) + variety_weight * variety_softmax
-
-                            # --- New idea: use the examples which the new model misclassifies the most as one of the new classes
-                            # This the opposite approach to softmax, where softmax takes the current model and calculates
-                            # Which classes does it confuse the new data for the most, this trains on the new data and then
-                            # Tries to find generated examples which it confuses for the new data classes the most
-                            elif sample_method == 'misclassified' or sample_method == 'uniform_large' or sample_method == 'random_large':
-                                metric = scores_new[:, -1] + scores_new[:, -1]
-
-                            # --- Sort based on some metric, then divide up by classes (afterwards) ---
+                        # (the scores are only used to select samples, so no autograd tracking is needed at all here; the
+                        #  restore happens outside inference-mode, so that the optimizer-state is not turned into inference tensors)
+                        if score_after_update:
+                            with inference_mode():
+                                curTaskID = task - 2
+                                newScores_og = model.classify(x_, not_hidden=False if Generative else True)
+                                newScores = newScores_og[:, :(classes_per_task * (curTaskID + 2))] # Logits that don't sum to 1
+                                if sample_method in ('interfered', 'misclassified'):
+                                    scores_new = F.softmax(newScores, dim=1) # Makes the scores sum to 1 (probabilities)
+
+                            # --- Undo the virtual update ---
+                            utils.restore_state(model, model_state)
+
+                        # --- Measure the difference in cross entropy loss for predictions before and after ---
+                        if sample_method == 'curated' or sample_method == "curated_softmax":
+                            loss_new = F.cross_entropy(newScores, y_used, reduction='none') # Per-example cross entropy (not avg)
+
+                            # Amount that the loss changes between the model updating
+                            diff = loss_new - loss_old
+                            metric = diff
+
+                        # TREVOR'S NEW METHOD - This tries to take into account the variety of the samples
+                        elif sample_method == "curated_variety" or sample_method == "curated_classVariety":
+                            loss_new = F.cross_entropy(newScores, y_used, reduction='none') # Per-example cross entropy (not avg)
+
+                            # Amount that the loss changes between the model updating
+                            diff = loss_new - loss_old
+                            
+                            # Softmaxing diff and the variety vector (to get probabilities)
+                            diff_softmax = F.softmax(diff, dim=0)
+                            variety_softmax = F.softmax(varietyVector, dim=0)
+                            metric = torch.lerp(diff_softmax, variety_softmax, variety_weight) #--> (1-w)*diff + w*variety
+
+                        # Multiply the misclassification error (cross entropy) by the amount that this changes between the model updating
+                        # metric = loss_new * diff
+
+                        # --- Measure KL Divergence between predictions before and predictions afterwards ---
+                        # Maximally Interfered Retrieval uses a linear combination of KL, entropy, and 'variance'
+                        # This ensures the samples are not too close together, but we do not currently measure that
+                        elif sample_method == 'interfered':
+                            # First, pad with zeros so predictions match (previous model predicts zero score for all new classes)
+                            padded_scores = torch.zeros_like(scores_new)
+                            padded_scores[:, :scores_old.size(1)] = scores_old
+                            kl_div = F.kl_div(padded_scores, scores_new, reduction='none')
+                            kl_div = torch.mean(kl_div, dim=1)
+                            variety_softmax = F.softmax(varietyVector, dim=0)
+
+                            # Calculate MIR loss and balance with variety (instead of explicitly searching, maximize both variety and MIR loss)
+                            mir_loss = torch.add(kl_div, loss_old, alpha=-mir_coef)           #--> kl_div - mir_coef*loss_old
+                            metric = torch.lerp(mir_loss, variety_softmax, variety_weight)  #--> (1-w)*mir_loss + w*variety
+
+                        # --- New idea: use the examples which the new model misclassifies the most as one of the new classes
+                        # This the opposite approach to softmax, where softmax takes the current model and calculates
+                        # Which classes does it confuse the new data for the most, this trains on the new data and then
+                        # Tries to find generated examples which it confuses for the new data classes the most
+                        elif sample_method == 'misclassified':
+                            metric = scores_new[:, -1] + scores_new[:, -1]
+
+                        # --- Sort based on some metric, then divide up by classes (afterwards) ---
+                        if sample_method == 'uniform_large' or sample_method == 'random_large':
+                            # -shuffle indices around to test choosing from this larger pool of generated samples randomly
+                            indices = torch.randperm(x_.size(0), device=device)
+                        else:
                             _, indices = torch.sort(metric, descending=True) # Descending order, pick first 100
 
-                            # Shuffle indices around to test choosing from this larger pool of generated samples randomly
-                            if sample_method == 'uniform_large' or sample_method == 'random_large':
-                                indices2 = indices.cpu().numpy()
-                                np.random.shuffle(indices2)
-                                indices = torch.from_numpy(indices2).to(device)
-
-                            if sample_method != 'random_large' and sample_method != 'curated_softmax':
-                                # --- Calculate how many examples for each class should be generated to divide up uniformly ---
-                                # Uniform dist will be [0, 1, 2, 3, 0, 1, 2] for allowed classes=4 and batch_size_replay=7
-                                uniform_dist = torch.arange(batch_size_replay) % len(allowed_classes)
-                                counts_each_class = torch.unique(uniform_dist, return_counts=True)[1]
-
-                                # --- Optional: Calculate unbalanced indices to replay, results in poor performance ---
-                                # If we added a variation term to ensure samples are different from each other, this could
-                                # be a simpler way to do things, but variance would be pretty complicated to calculate
-                                #indices_to_replay = indices[:batch_size_replay]
-
-                                # --- Select the top k_i indices for each class i, where k_i is the number of examples for that class ---
-                                # Top x most affected of the generated samples for each class (ensures it is balanced, slightly more computation than unbalanced)
-                                indices_to_replay = torch.cat(( [ indices[y_used[indices]==i][:counts_each_class[i]] for i in range(len(allowed_classes)) ] ))
-                                x_ = x_[indices_to_replay]
-                            else:
-                                # Uniformly randomly choose from the 400 samples generated
-                                x_ = x_[indices]
+                        if sample_method != 'random_large' and sample_method != 'curated_softmax':
+                            # --- The number of examples for each class to divide up uniformly is in [counts_each_class] ---
+
+                            # --- Optional: Calculate unbalanced indices to replay, results in poor performance ---
+                            # If we added a variation term to ensure samples are different from each other, this could
+                            # be a simpler way to do things, but variance would be pretty complicated to calculate
+                            #indices_to_replay = indices[:batch_size_replay]
+
+                            # --- Select the top k_i indices for each class i, where k_i is the number of examples for that class ---
+                            # Top x most affected of the generated samples for each class (ensures it is balanced, slightly more computation than unbalanced)
+                            # (for each sorted sample, find its rank among the samples of the same class; keep it if that rank
+                            # is below the count of its class -- this way all classes are handled in one go)
+                            y_sorted = y_used[indices]
+                            rank_in_class = F.one_hot(y_sorted, num_classes=len(allowed_classes)).cumsum(dim=0).gather(
+                                dim=1, index=y_sorted.unsqueeze(1)
+                            ).squeeze(1) - 1
+                            indices_to_replay = indices[rank_in_class < counts_each_class[y_sorted]]
+                            x_ = x_[indices_to_replay]
+                        else:
+                            # Replay all samples generated (in random order, or from best to worst if 'curated_softmax')
+                            x_ = x_[indices]
 
             #--------------------------------------------OUTPUTS----------------------------------------------------#
 
@@ -445,33 +485,41 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
                             scenario=="class"
                     ) else all_scores_ # -> when scenario=="class", zero probs will be added in [loss_fn_kd]-function
                     # -also get the 'hard target'
-                    _, y_ = torch.max(scores_, dim=1)
+                    y_ = scores_.argmax(dim=1)
                 else:
                     # -[x_] needs to be evaluated according to each previous task, so make list with entry per task
-                    scores_ = list()
-                    y_ = list()
-                    # -if no task-mask and no conditional generator, all scores can be calculated in one go
                     if previous_model.mask_dict is None and not type(x_)==list:
+                        # -if no task-mask and no conditional generator, all scores can be calculated in one go (and
+                        #  they can be split up per task, and their hard targets found, for all previous tasks together)
                         with torch.no_grad():
                             all_scores_ = previous_model.classify(x_, not_hidden=False if Generative else True)
-                    for task_id in range(task-1):
-                        # -if there is a task-mask (i.e., XdG is used), obtain predicted scores for each task separately
-                        if previous_model.mask_dict is not None:
-                            previous_model.apply_XdGmask(task=task_id+1)
-                        if previous_model.mask_dict is not None or type(x_)==list:
+                        scores_per_task_ = all_scores_[:, :(classes_per_task*(task-1))].view(
+                            -1, task-1, classes_per_task
+                        )
+                        scores_ = list(scores_per_task_.unbind(dim=1))
+                        y_ = list(scores_per_task_.argmax(dim=2).unbind(dim=1))
+                    else:
+                        scores_ = list()
+                        y_ = list()
+                        for task_id in range(task-1):
+                            # -if there is a task-mask (i.e., XdG is used) or a conditional generator (i.e., [x_] is a
+                            #  list), obtain predicted scores for each task separately
+                            if previous_model.mask_dict is not None:
+                                previous_model.apply_XdGmask(task=task_id+1)
                             with torch.no_grad():
                                 all_scores_ = previous_model.classify(x_[task_id] if type(x_)==list else x_,
                                                                       not_hidden=False if Generative else True)
-                        if scenario=="domain":
-                            # NOTE: if scenario=domain with task-mask, it's of course actually the Task-IL scenario!
-                            #       this can be used as trick to run the Task-IL scenario with singlehead output layer
-                            temp_scores_ = all_scores_
-                        else:
-                            temp_scores_ = all_scores_[:, (classes_per_task*task_id):(classes_per_task*(task_id+1))]
-                        scores_.append(temp_scores_)
-                        # - also get hard target
-                        _, temp_y_ = torch.max(temp_scores_, dim=1)
-                        y_.append(temp_y_)
+                            if scenario=="domain":
+                                # NOTE: if scenario=domain with task-mask, it's of course actually the Task-IL scenario!
+                                #       this can be used as trick to run the Task-IL scenario with singlehead output
+                                #       layer
+                                temp_scores_ = all_scores_
+                            else:
+                                temp_scores_ = all_scores_.narrow(1, classes_per_task*task_id, classes_per_task)
+                            scores_.append(temp_scores_)
+                            # - also get hard target
+                            temp_y_ = temp_scores_.argmax(dim=1)
+                            y_.append(temp_y_)
             # -only keep predicted y_/scores_ if required (as otherwise unnecessary computations will be done)
             y_ = y_ if (model.replay_targets=="hard") else None
             scores_ = scores_ if (model.replay_targets=="soft") else None
@@ -485,9 +533,8 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
 
                 # Train the main model with this batch
                 loss_dict = model.train_a_batch(x, y=y, x_=x_, y_=y_, scores_=scores_,
-                                                tasks_=task_used, active_classes=active_classes, task=task, rnt=(
-                                                    1. if task==1 else 1./task
-                                                ) if rnt is None else rnt, freeze_convE=freeze_convE,
+                                                tasks_=task_used, active_classes=active_classes, task=task,
+                                                rnt=rnt_to_use, freeze_convE=freeze_convE,
                                                 replay_not_hidden=False if Generative else True)
 
 
@@ -497,63 +544,60 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
 
 
                 # Update running parameter importance estimates in W
-                if isinstance(model, ContinualLearner) and model.si_c>0:
-                    for n, p in model.convE.named_parameters():
-                        if p.requires_grad:
-                            n = "convE."+n
-                            n = n.replace('.', '__')
-                            if p.grad is not None:
-                                W[n].add_(-p.grad*(p.detach()-p_old[n]))
-                            p_old[n] = p.detach().clone()
-                    for n, p in model.fcE.named_parameters():
-                        if p.requires_grad:
-                            n = "fcE."+n
-                            n = n.replace('.', '__')
-                            if p.grad is not None:
-                                W[n].add_(-p.grad * (p.detach() - p_old[n]))
-                            p_old[n] = p.detach().clone()
-                    for n, p in model.classifier.named_parameters():
-                        if p.requires_grad:
-                            n = "classifier."+n
-                            n = n.replace('.', '__')
-                            if p.grad is not None:
-                                W[n].add_(-p.grad * (p.detach() - p_old[n]))
-                            p_old[n] = p.detach().clone()
+                if SI:
+                    # -only parameters that receive a gradient contribute to [W] (but for all of them [p_old] is updated);
+                    #  which parameters these are does not change during a task, so this is only checked once
+                    if with_grad is None:
+                        with_grad = [i for i, (_, p) in enumerate(si_updated) if p.grad is not None]
+                        params_with_grad = [si_updated[i][1] for i in with_grad]
+                        values_with_grad = [si_values[i] for i in with_grad]
+                        W_with_grad = [W_list[i] for i in with_grad]
+                        p_old_with_grad = [p_old_list[i] for i in with_grad]
+                    with torch.no_grad():
+                        # -the buffers of [p_old] are about to be overwritten anyway, so they are used to hold
+                        #  -(p - p_old), such that no temporary tensors are needed for W += -grad * (p - p_old)
+                        if si_foreach:
+                            if len(with_grad)>0:
+                                torch._foreach_sub_(p_old_with_grad, values_with_grad)
+                                torch._foreach_addcmul_(W_with_grad, [p.grad for p in params_with_grad],
+                                                        p_old_with_grad)
+                            torch._foreach_copy_(p_old_list, si_values)
+                        else:
+                            for W_n, p, value, p_old in zip(W_with_grad, params_with_grad, values_with_grad,
+                                                            p_old_with_grad):
+                                W_n.addcmul_(p.grad, p_old.sub_(value))
+                            for p_old, value in zip(p_old_list, si_values):
+                                p_old.copy_(value)
 
                 # Fire callbacks (for visualization of training-progress / evaluating performance after each task)
                 for loss_cb in loss_cbs:
-                    if loss_cb is not None:
-                        loss_cb(progress, batch_index, loss_dict, task=task)
-                for eval_cb in eval_cbs:
-                    if eval_cb is not None:
+                    loss_cb(progress, batch_index, loss_dict, task=task)
+                for eval_cb, offset, log in eval_cbs_task:
+                    if (offset + batch_index) % log == 0:
                         eval_cb(model, batch_index, task=task)
-                if model.label=="VAE":
-                    for sample_cb in sample_cbs:
-                        if sample_cb is not None:
-                            sample_cb(model, batch_index, task=task, allowed_classes=None if (
-                                    scenario=="domain"
-                            ) else list(range(classes_per_task*task)))
+                if sample_main_model:
+                    for sample_cb, offset, log in sample_cbs_task:
+                        if (offset + batch_index) % log == 0:
+                            sample_cb(model, batch_index, task=task, allowed_classes=sample_cb_classes)
 
 
             #---> Train GENERATOR
             if generator is not None and batch_index <= iters_gen:
 
                 loss_dict = generator.train_a_batch(x, y=y, x_=x_, y_=y_, scores_=scores_,
-                                                    tasks_=task_used, active_classes=active_classes, rnt=(
-                                                        1. if task==1 else 1./task
-                                                    ) if rnt is None else rnt, task=task,
-                                                    freeze_convE=freeze_convE,
+                                                    tasks_=task_used, active_classes=active_classes,
+                                                    rnt=rnt_to_use, task=task, freeze_convE=freeze_convE,
                                                     replay_not_hidden=False if Generative else True)
 
                 # Fire callbacks on each iteration
                 for loss_cb in gen_loss_cbs:
-                    if loss_cb is not None:
-                        loss_cb(progress_gen, batch_index, loss_dict, task=task)
-                for sample_cb in sample_cbs:
-                    if sample_cb is not None:
-                        sample_cb(generator, batch_index, task=task, allowed_classes=None if (
-                                    scenario=="domain"
-                            ) else list(range(classes_per_task*task)))
+                    loss_cb(progress_gen, batch_index, loss_dict, task=task)
+                for sample_cb, offset, log in sample_cbs_task:
+                    if (offset + batch_index) % log == 0:
+                        sample_cb(generator, batch_index, task=task, allowed_classes=sample_cb_classes)
+
+            # Release the replayed data (and its targets) right away, so that its memory can be reused for the next batch
+            del x_, y_, scores_, loss_dict
 
 
         # Close progres-bar(s)
@@ -565,7 +609,7 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
         ##----------> UPON FINISHING EACH TASK...
 
         # EWC: estimate Fisher Information matrix (FIM) and update term for quadratic penalty
-        if isinstance(model, ContinualLearner) and model.ewc_lambda>0:
+        if EWC:
             # -find allowed classes
             allowed_classes = list(
                 range(classes_per_task*(task-1), classes_per_task*task)
@@ -577,13 +621,29 @@ def train_cl(model, train_datasets, replay_mode="none", scenario="task", rnt=Non
             model.estimate_fisher(train_dataset, allowed_classes=allowed_classes)
 
         # SI: calculate and update the normalized path integral
-        if isinstance(model, ContinualLearner) and model.si_c>0:
+        if SI:
             model.update_omega(W, model.epsilon)
 
         # REPLAY: update source for replay
-        previous_model = copy.deepcopy(model).eval()
+        # -a copy of the model is only made once, after that the model's current state is loaded into this copy
+        #  (buffers that are only in the model, such as those of later tasks for offline EWC, are not needed for replay)
+        if replay_mode in ("generative", "current"):
+            if previous_model is None:
+                previous_model = utils.copy_model(model).eval()
+            else:
+                previous_model.load_state_dict(model.state_dict(), strict=False)
         if replay_mode=="generative":
             Generative = True
-            previous_generator = previous_model if feedback else copy.deepcopy(generator).eval()
+            # -with a separate generator, the same is done for a copy of the generator
+            if feedback:
+                previous_generator = previous_model
+            elif previous_generator is None:
+                previous_generator = utils.copy_model(generator).eval()
+            else:
+                previous_generator.load_state_dict(generator.state_dict(), strict=False)
         elif replay_mode=='current':
             Current = True
+
+        # Return cached memory that is no longer used (e.g., blocks of the previous task's batch-sizes) to the GPU
+        if cuda:
+            torch.cuda.empty_cache()
@@ -1,4 +1,6 @@
 import os
+import copy
+import inspect
 import pickle
 import torch
 from torch import nn
@@ -16,6 +18,12 @@ def checkattr(args, attr):
     '''Check whether attribute exists, whether it's a boolean and whether its value is True.'''
     return hasattr(args, attr) and type(getattr(args, attr))==bool and getattr(args, attr)
 
+def fused_kwargs(optimizer_class, fused=False):
+    '''Return <dict> with keyword-argument to select the fused implementation of [optimizer_class], if requested (only
+    on the GPU) and if supported by the installed version of PyTorch (otherwise an empty <dict>).'''
+    fused = fused and 'fused' in inspect.signature(optimizer_class).parameters
+    return {'fused': True} if fused else {}
+
 
 ##-------------------------------------------------------------------------------------------------------------------##
 
@@ -38,6 +46,57 @@ def get_data_loader(dataset, batch_size, cuda=False, collate_fn=label_squeezing_
     )
 
 
+class DataPrefetcher(object):
+    '''Iterator over the batches of a <DataLoader>, which already moves the next batch to [device].
+
+    On the GPU, the next batch is copied on a separate CUDA-stream, so that this host-to-device transfer overlaps
+    with the computations on the current batch (for this, the <DataLoader> should use pinned memory).
+    If [cycle] is True, the <DataLoader> is restarted (i.e., a new epoch begins) whenever it is exhausted.'''
+
+    def __init__(self, data_loader, device, cycle=False):
+        self.data_loader = data_loader
+        self.cycle = cycle
+        self.loader = iter(data_loader)
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type=="cuda" else None
+        self.preload()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        return self
+
+    def preload(self):
+        try:
+            x, y = next(self.loader)
+        except StopIteration:
+            if not self.cycle:
+                self.next_x = self.next_y = None
+                return
+            self.loader = iter(self.data_loader)
+            x, y = next(self.loader)
+        if self.stream is None:
+            self.next_x, self.next_y = x.to(self.device), y.to(self.device)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.next_x = x.to(self.device, non_blocking=True)
+                self.next_y = y.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        if self.stream is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        x, y = self.next_x, self.next_y
+        if x is None:
+            raise StopIteration
+        if self.stream is not None:
+            # -make sure memory of this batch is not reused before the computations on the main stream are done
+            x.record_stream(torch.cuda.current_stream(self.device))
+            y.record_stream(torch.cuda.current_stream(self.device))
+        self.preload()
+        return x, y
+
+
 ##-------------------------------------------------------------------------------------------------------------------##
 
 ##########################################
@@ -98,6 +157,46 @@ def load_checkpoint(model, model_dir, verbose=True, name=None, add_si_buffers=Fa
         print(' --> loaded checkpoint of {name} from {path}'.format(name=name, path=model_dir))
 
 
+def snapshot_state(model):
+    '''Return in-memory copy of the state of [model] (and of its optimizer), which can be put back by [restore_state].'''
+    model_state = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+    optimizer = getattr(model, "optimizer", None)
+    optim_state = None if optimizer is None else copy.deepcopy(optimizer.state_dict())
+    return model_state, optim_state
+
+
+def restore_state(model, snapshot):
+    '''Put the state of [model] (and of its optimizer) back to the copy in [snapshot], as made by [snapshot_state].'''
+    model_state, optim_state = snapshot
+    model.load_state_dict(model_state)
+    if optim_state is not None:
+        model.optimizer.load_state_dict(optim_state)
+
+
+def flat_buffer(tensors):
+    '''Allocate a single contiguous (zero-initialized) buffer with room for all of [tensors], and return it together
+    with a <list> of views into this buffer that are shaped like each of [tensors].'''
+    device = tensors[0].device if len(tensors)>0 else None
+    dtype = tensors[0].dtype if len(tensors)>0 else None
+    flat = torch.zeros(sum(tensor.numel() for tensor in tensors), device=device, dtype=dtype)
+    views = list()
+    offset = 0
+    for tensor in tensors:
+        views.append(flat.narrow(0, offset, tensor.numel()).view_as(tensor))
+        offset += tensor.numel()
+    return flat, views
+
+
+def copy_model(model):
+    '''Return a deep copy of [model]; sub-networks that were compiled in place are compiled again for the copy
+    (otherwise the compiled forward-pass of the copy would still run the original sub-network).'''
+    model_copy = copy.deepcopy(model)
+    for module in model_copy.modules():
+        if hasattr(module, "compile_mode"):
+            module.compile(mode=module.compile_mode)
+    return model_copy
+
+
 ##-------------------------------------------------------------------------------------------------------------------##
 
 ################################